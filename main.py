@@ -1,13 +1,19 @@
+import argparse
+import atexit
+import logging
+import logging.handlers
 import os
+import queue
 import subprocess
-import json
+import sys
+import tempfile
+import threading
 import concurrent.futures
-from typing import Optional, Dict, List, Tuple
+from typing import Callable, Optional, Dict, List, Tuple
+import itertools
 import math
 import psutil
-from mutagen.easyid3 import EasyID3
-from mutagen.mp3 import MP3
-from mutagen.id3 import ID3, APIC, TIT2, TPE1, TALB
+from yt_dlp import YoutubeDL
 
 
 # Configuration
@@ -15,19 +21,62 @@ PLAYLIST_URL = (
     "https://www.youtube.com/playlist?list=PLn9b2rpdRYi7gNmL_I_fGdfm5HnQeLCE-"
 )
 DOWNLOAD_PATH = "/home/yann/Work/sync-jam-playlist/audio_downloads"
-METADATA_FILE = os.path.join(DOWNLOAD_PATH, "playlist_metadata.json")
+METADATA_FILE = os.path.join(DOWNLOAD_PATH, "playlist_metadata.tsv")
+IDS_FILE = os.path.join(DOWNLOAD_PATH, ".ids")  # One downloaded video ID per line
 CONCURRENT_FRAGMENTS = "8"
+MIN_BATCH_SIZE = 25  # Videos per yt-dlp process before the work is split further
 
 
 os.makedirs(DOWNLOAD_PATH, exist_ok=True)
 
+class _UnformattedQueueHandler(logging.handlers.QueueHandler):
+    """
+    Enqueues records as-is. The stock prepare() formats the message on the
+    calling thread; the queue never leaves this process, so leave that to the
+    listener.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+# Workers only enqueue log records, a background listener formats and writes them
+log_queue: queue.Queue = queue.Queue(-1)
+logger = logging.getLogger(__name__)
+logger.setLevel(logging.INFO)
+logger.addHandler(_UnformattedQueueHandler(log_queue))
+logger.propagate = False
+log_listener = logging.handlers.QueueListener(
+    log_queue, logging.StreamHandler(sys.stdout)
+)
+log_listener.start()
+atexit.register(log_listener.stop)
+
+
+def load_previous_metadata():
+    """Loads previous playlist metadata."""
+    entries = []
+    if os.path.exists(METADATA_FILE):
+        with open(METADATA_FILE, "r", encoding="utf-8") as f:
+            for line in f:
+                fields = line.rstrip("\n").split("\t", 2)
+                if len(fields) != 3:
+                    continue  # Skip malformed lines, e.g. from an old interrupted write
+                video_id, title, url = fields
+                entries.append({"id": video_id, "title": title, "url": url})
+    return {"entries": entries}
+
 
 def get_optimal_config() -> Tuple[int, int, int]:
     """
     Determines optimal worker count and segment size based on system resources.
     Returns: (workers, segment_size, total_videos)
     """
-    cpu_count = os.cpu_count() or 2
+    # Only count the CPUs this process may run on (containers, taskset)
+    if hasattr(os, "sched_getaffinity"):
+        cpu_count = len(os.sched_getaffinity(0))
+    else:
+        cpu_count = os.cpu_count() or 2
     available_memory_gb = psutil.virtual_memory().available / (1024**3)
 
     # Base workers calculation on CPU cores
@@ -40,6 +89,14 @@ def get_optimal_config() -> Tuple[int, int, int]:
     optimal_workers = min(base_workers, max_workers_by_memory, 8)
     workers = max(2, optimal_workers)  # Ensure at least 2 workers
 
+    # Use the count from the previous sync when available, new videos are
+    # picked up by fetch_playlist_info
+    previous_entries = load_previous_metadata()["entries"]
+    if previous_entries:
+        total_videos = len(previous_entries)
+        segment_size = min(200, max(100, total_videos // (workers * 2)))
+        return workers, segment_size, total_videos
+
     # Get total videos count
     cmd = ["yt-dlp", "--flat-playlist", "--print", "%(playlist_count)s", PLAYLIST_URL]
     result = subprocess.run(cmd, capture_output=True, text=True)
@@ -48,7 +105,7 @@ def get_optimal_config() -> Tuple[int, int, int]:
         total_videos = int(result.stdout.splitlines()[0])
         segment_size = min(200, max(100, total_videos // (workers * 2)))
     else:
-        print("❌ Error: Could not fetch playlist size. Using defaults.")
+        logger.error("❌ Error: Could not fetch playlist size. Using defaults.")
         total_videos = 0
         segment_size = 150  # Default fallback
 
@@ -57,110 +114,188 @@ def get_optimal_config() -> Tuple[int, int, int]:
 
 # Get optimal configuration
 MAX_WORKERS, SEGMENT_SIZE, TOTAL_VIDEOS = get_optimal_config()
-print(
-    f"🔧 Optimized configuration: {MAX_WORKERS} workers, {SEGMENT_SIZE} videos per segment"
+# YouTube throttles concurrent playlist requests, more threads only add overhead
+FETCH_CONCURRENCY = min(MAX_WORKERS, 4)
+logger.info(
+    "🔧 Optimized configuration: %d workers, %d videos per segment",
+    MAX_WORKERS,
+    SEGMENT_SIZE,
 )
 
 
-def fetch_playlist_segment(start_index: int) -> Optional[Dict]:
-    """Fetches a segment of the playlist metadata."""
-    cmd = [
-        "yt-dlp",
-        "-J",
-        "--flat-playlist",
-        "--playlist-start",
-        str(start_index),
-        "--playlist-end",
-        str(start_index + SEGMENT_SIZE - 1),
-        PLAYLIST_URL,
-    ]
+# One YoutubeDL per fetch thread, see get_ydl()
+_thread_local = threading.local()
 
-    result = subprocess.run(cmd, capture_output=True, text=True)
-    return json.loads(result.stdout) if result.returncode == 0 else None
+
+def get_ydl() -> YoutubeDL:
+    """
+    Returns the calling thread's YoutubeDL instance, creating it on first use.
+    Reusing it across segments keeps its HTTP connections, cookies and
+    extractors alive instead of rebuilding them for every segment.
+    """
+    ydl = getattr(_thread_local, "ydl", None)
+    if ydl is None:
+        ydl = YoutubeDL({"quiet": True, "no_warnings": True, "extract_flat": True})
+        _thread_local.ydl = ydl
+    return ydl
 
 
-def fetch_playlist_info() -> Optional[Dict]:
-    """Fetches the playlist metadata in parallel segments."""
-    if TOTAL_VIDEOS == 0:
-        print("❌ Error: Could not fetch playlist data.")
+def fetch_playlist_segment(start_index: int) -> Optional[Dict]:
+    """Fetches a segment of the playlist metadata."""
+    try:
+        ydl = get_ydl()
+        ydl.params["playliststart"] = start_index
+        ydl.params["playlistend"] = start_index + SEGMENT_SIZE - 1
+        info = ydl.extract_info(PLAYLIST_URL, download=False)
+        return ydl.sanitize_info(info)
+    except Exception as e:
+        logger.error("Error fetching segment starting at %d: %s", start_index, e)
         return None
 
-    num_segments = math.ceil(TOTAL_VIDEOS / SEGMENT_SIZE)
-    print(
-        f"📊 Playlist contains {TOTAL_VIDEOS} videos. Fetching in {num_segments} segments..."
-    )
 
-    segments: List[Dict] = []
+def fetch_segments(
+    segment_indices: range, on_segment: Optional[Callable[[Dict], None]] = None
+) -> List[Optional[Dict]]:
+    """
+    Fetches the given playlist segments in parallel, returned in playlist order
+    (None for failed segments).
+    on_segment, if given, is called with each segment as soon as it is fetched.
+    """
+    segments: List[Optional[Dict]] = [None] * len(segment_indices)
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=FETCH_CONCURRENCY
+    ) as executor:
         future_to_segment = {
             executor.submit(
                 fetch_playlist_segment,
                 i * SEGMENT_SIZE + 1,  # start_index (1-based)
             ): i
-            for i in range(num_segments)
+            for i in segment_indices
         }
 
         for future in concurrent.futures.as_completed(future_to_segment):
+            segment_index = future_to_segment[future]
             segment_data = future.result()
             if segment_data:
-                segments.append(segment_data)
+                segments[segment_index - segment_indices.start] = segment_data
+                if on_segment:
+                    on_segment(segment_data)
             else:
-                print(f"❌ Failed to fetch segment {future_to_segment[future]}")
+                logger.error("❌ Failed to fetch segment %d", segment_index)
 
-    if not segments:
+    return segments
+
+
+def fetch_playlist_info(
+    on_segment: Optional[Callable[[Dict], None]] = None
+) -> Optional[Dict]:
+    """Fetches the playlist metadata in parallel segments."""
+    if TOTAL_VIDEOS == 0:
+        logger.error("❌ Error: Could not fetch playlist data.")
         return None
 
-    # Combine all segments into one playlist
-    combined_playlist = segments[0]
-    combined_playlist["entries"] = []
+    num_segments = math.ceil(TOTAL_VIDEOS / SEGMENT_SIZE)
+    logger.info(
+        "📊 Playlist contains %d videos. Fetching in %d segments...",
+        TOTAL_VIDEOS,
+        num_segments,
+    )
 
-    for segment in segments:
-        combined_playlist["entries"].extend(segment.get("entries", []))
+    segments = fetch_segments(range(num_segments), on_segment)
 
-    return combined_playlist
+    if not any(segments):
+        return None
 
+    # The video count may come from the previous sync, fetch what was added since
+    playlist_count = max(
+        segment.get("playlist_count") or 0 for segment in segments if segment
+    )
+    if playlist_count > num_segments * SEGMENT_SIZE:
+        total_segments = math.ceil(playlist_count / SEGMENT_SIZE)
+        logger.info(
+            "📊 Playlist grew to %d videos. Fetching %d more segments...",
+            playlist_count,
+            total_segments - num_segments,
+        )
+        segments.extend(
+            fetch_segments(range(num_segments, total_segments), on_segment)
+        )
 
-def load_previous_metadata():
-    """Loads previous playlist metadata."""
-    if os.path.exists(METADATA_FILE):
-        with open(METADATA_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"entries": []}
+    # Combine all segments into one playlist, keeping the playlist order
+    combined_playlist = next(segment for segment in segments if segment)
+    combined_playlist["entries"] = list(
+        itertools.chain.from_iterable(
+            segment.get("entries", []) for segment in segments if segment
+        )
+    )
+
+    return combined_playlist
 
 
 def save_metadata(metadata):
-    """Saves playlist metadata for future comparison."""
-    with open(METADATA_FILE, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, indent=4)
-
-
-def get_existing_files():
-    """Get a set of downloaded audio files (by ID)."""
-    existing_files = set()
-    for f in os.listdir(DOWNLOAD_PATH):
-        if f.endswith(".mp3"):
-            # Extract the ID from the filename (assuming format "Title - ID.mp3")
-            video_id = f.split(" - ")[-1].replace(".mp3", "")
-            existing_files.add(video_id)
+    """Saves playlist metadata for future comparison (one id/title/url per line)."""
+    # Write to a temporary file and swap it in, so an interrupted sync never
+    # leaves a partial METADATA_FILE behind
+    with tempfile.NamedTemporaryFile(
+        "w", dir=DOWNLOAD_PATH, delete=False, encoding="utf-8"
+    ) as f:
+        f.writelines(
+            "{}\t{}\t{}\n".format(
+                entry["id"],
+                " ".join((entry.get("title") or "").split()),  # No tabs/newlines
+                entry.get("url") or "",
+            )
+            for entry in metadata["entries"]
+        )
+    os.replace(f.name, METADATA_FILE)
+
+
+# Serializes appends to IDS_FILE from concurrent download batches
+_ids_lock = threading.Lock()
+
+
+def record_downloaded_ids(video_ids: List[str]):
+    """Appends newly downloaded IDs to the IDS_FILE index."""
+    if not video_ids:
+        return
+    with _ids_lock, open(IDS_FILE, "a", encoding="utf-8") as f:
+        f.write("".join(f"{video_id}\n" for video_id in video_ids))
+
+
+def get_existing_files(verify: bool = False):
+    """
+    Get a set of downloaded audio files (by ID).
+    Reads the IDS_FILE index, or rebuilds it from the download folder when it
+    is missing or verify is set.
+    """
+    if not verify and os.path.exists(IDS_FILE):
+        with open(IDS_FILE, "r", encoding="utf-8") as f:
+            return set(f.read().split())
+
+    with os.scandir(DOWNLOAD_PATH) as it:
+        # Extract the ID from the filename (assuming format "Title - ID.mp3")
+        existing_files = {
+            entry.name.rpartition(" - ")[2][:-4]
+            for entry in it
+            if entry.name.endswith(".mp3")
+        }
+
+    with _ids_lock, open(IDS_FILE, "w", encoding="utf-8") as f:
+        f.write("".join(f"{video_id}\n" for video_id in existing_files))
     return existing_files
 
 
-def download_audio(entry):
-    """Downloads a single audio file using yt-dlp."""
-    video_id = entry["id"]
+def download_batch(entries: List[Dict], album: str) -> List[str]:
+    """Downloads a batch of audio files with a single yt-dlp invocation."""
     output_path = os.path.join(DOWNLOAD_PATH, "%(title)s - %(id)s.%(ext)s")
 
-    if not isinstance(output_path, str):
-        print("Error: output_path is not a string")
-        return None
-
-    if not isinstance(entry["url"], str):
-        print(f"Error: Invalid URL for video {entry['title']}")
-        return None
+    urls = [entry["url"] for entry in entries]
 
     cmd = [
         "yt-dlp",
+        "-a",
+        "-",  # Read the batch of URLs from stdin
         "-f",
         "bestaudio",
         "--extract-audio",
@@ -172,93 +307,123 @@ def download_audio(entry):
         "%(uploader)s:%(meta_artist)s",  # Set video uploader as artist
         "--parse-metadata",
         "%(title)s:%(meta_title)s",  # Set video title as track title
+        # Set playlist title as album: create an empty meta_album, then replace
+        # it, so the title is only ever used as a (backslash-escaped) literal
+        "--parse-metadata",
+        ":(?P<meta_album>)",
+        "--replace-in-metadata",
+        "meta_album",
+        "^$",
+        album.replace("\\", "\\\\"),
         "--add-metadata",  # Ensure metadata is written to the file
         "--concurrent-fragments",
         CONCURRENT_FRAGMENTS,
         "--no-progress",
+        "--print",
+        "after_move:%(id)s",  # Report each finished file
         "-o",
         output_path,
-        entry["url"],
     ]
 
-    print(f"Starting download: {entry['title']}")
-    print(f"Running command: {cmd}")
-    result = subprocess.run(cmd, capture_output=True, text=True)
+    logger.info("Starting batch download of %d files", len(urls))
+    result = subprocess.run(
+        cmd, input="\n".join(urls) + "\n", capture_output=True, text=True
+    )
 
-    if result.returncode == 0:
-        filepath = os.path.join(DOWNLOAD_PATH, f"{entry['title']} - {video_id}.mp3")
-        update_metadata(
-            filepath,
-            title=entry["title"],
-            artist=entry.get("uploader", "Unknown"),
-            album=entry.get("playlist_title", "YouTube Playlist"),
-        )
-        print(f"✔ Downloaded: {entry['title']}")
-        return video_id
-    else:
-        print(f"❌ Failed: {entry['title']}\nError: {result.stderr}")
-        return None
+    entries_by_id = {entry["id"]: entry for entry in entries}
+    downloaded = []
 
+    for video_id in result.stdout.splitlines():
+        entry = entries_by_id.get(video_id)
+        if entry is None:
+            continue
 
-def parallel_download(playlist_data, existing_files):
-    """Download missing audio files in parallel."""
-    to_download = [
-        entry for entry in playlist_data["entries"] if entry["id"] not in existing_files
-    ]
+        logger.info("✔ Downloaded: %s", entry["title"])
+        downloaded.append(video_id)
 
-    if not to_download:
-        print("✅ All files are up to date.")
-        return []
+    record_downloaded_ids(downloaded)
 
-    print(f"🚀 Downloading {len(to_download)} new files with {MAX_WORKERS} threads...")
+    if len(downloaded) < len(urls):
+        logger.error(
+            "❌ Failed: %d of %d files\nError: %s",
+            len(urls) - len(downloaded),
+            len(urls),
+            result.stderr,
+        )
 
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        results = list(executor.map(download_audio, to_download))
+    return downloaded
 
-    return [r for r in results if r]
 
+def parallel_download(
+    playlist_data, existing_files, executor: concurrent.futures.Executor
+) -> List[concurrent.futures.Future]:
+    """
+    Queue missing audio files for download in parallel batches.
+    Queued IDs are added to existing_files so later segments skip them.
+    """
+    to_download = []
+    for entry in playlist_data["entries"]:
+        if entry["id"] not in existing_files:
+            existing_files.add(entry["id"])  # Also skips duplicates within the playlist
+            to_download.append(entry)
 
-def update_metadata(filepath, title, artist, album=None):
-    """Update MP3 metadata after download."""
-    try:
-        audio = MP3(filepath, ID3=ID3)
+    if not to_download:
+        return []
 
-        # Create ID3 tag if it doesn't exist
-        if not audio.tags:
-            audio.add_tags()
+    # yt-dlp downloads a batch file sequentially, so split larger work into
+    # up to one batch per worker, but keep each batch at MIN_BATCH_SIZE or more
+    # so small syncs don't pay for a yt-dlp startup per video
+    num_batches = min(MAX_WORKERS, math.ceil(len(to_download) / MIN_BATCH_SIZE))
+    batches = [to_download[i::num_batches] for i in range(num_batches)]
 
-        # Set the metadata
-        audio.tags.add(TIT2(encoding=3, text=title))
-        audio.tags.add(TPE1(encoding=3, text=artist))
-        if album:
-            audio.tags.add(TALB(encoding=3, text=album))
+    logger.info(
+        "🚀 Downloading %d new files in %d batches...", len(to_download), len(batches)
+    )
 
-        audio.save()
-        print(f"Updated metadata for: {filepath}")
-    except Exception as e:
-        print(f"Error updating metadata: {e}")
+    album = playlist_data.get("title") or "YouTube Playlist"
+    return [executor.submit(download_batch, batch, album) for batch in batches]
 
 
-def sync_playlist():
+def sync_playlist(verify: bool = False):
     """Main function to sync playlist audio downloads."""
-    print("🔄 Fetching playlist info...")
-    playlist_data = fetch_playlist_info()
+    existing_files = get_existing_files(verify)
+    logger.info("📂 Found %d existing audio files.", len(existing_files))
+
+    download_futures: List[concurrent.futures.Future] = []
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        logger.info("🔄 Fetching playlist info...")
+        # Start downloading each segment's new files as soon as it is fetched.
+        # Callbacks run on this thread, so existing_files needs no lock
+        playlist_data = fetch_playlist_info(
+            on_segment=lambda segment: download_futures.extend(
+                parallel_download(segment, existing_files, executor)
+            )
+        )
+        new_audios = [
+            video_id for future in download_futures for video_id in future.result()
+        ]
+
     if not playlist_data:
-        print("❌ Error: Could not fetch playlist data.")
+        logger.error("❌ Error: Could not fetch playlist data.")
         return
 
-    existing_files = get_existing_files()
-    print(f"📂 Found {len(existing_files)} existing audio files.")
-
-    # Download in parallel
-    new_audios = parallel_download(playlist_data, existing_files)
+    if not download_futures:
+        logger.info("✅ All files are up to date.")
     if new_audios:
-        print(f"✔ Downloaded {len(new_audios)} new files.")
-    print("✅ Sync complete.")
+        logger.info("✔ Downloaded %d new files.", len(new_audios))
+    logger.info("✅ Sync complete.")
 
     # Save updated metadata
     save_metadata(playlist_data)
 
 
 if __name__ == "__main__":
-    sync_playlist()
+    parser = argparse.ArgumentParser(description="Sync a YouTube playlist as MP3s.")
+    parser.add_argument(
+        "--verify",
+        action="store_true",
+        help="rebuild the downloaded IDs index from the files on disk",
+    )
+    args = parser.parse_args()
+    sync_playlist(verify=args.verify)